@@ -0,0 +1,418 @@
+# signal_generation_transformer_ddp.py
+# University of Kentucky
+
+# DISTRIBUTED TRAINING
+# Trains the Transformer Signal Generation 10 model (Transfer Learning with Repeated Embedding) as a
+# torch.distributed job on CPUs with the gloo backend. Each process trains on its own shard of the
+# stackup_set_1 welds and DistributedDataParallel all-reduces the gradients after every batch.
+# Checkpoints, losses and the final test on dataset2_test are only handled by rank 0.
+#
+# USAGE:
+#   Single machine, spawned processes:   python signal_generation_transformer_ddp.py --data "DOE 1 v3 [Modified].h5" --nproc 4
+#   One or more machines with torchrun:  torchrun --nnodes 2 --nproc_per_node 2 --rdzv_endpoint host:29500 signal_generation_transformer_ddp.py --data ...
+#   Scaling report (1, 2, 4, 8 ranks):   python signal_generation_transformer_ddp.py --data ... --scaling-report 1 2 4 8 --epochs 5
+#
+# NOTE: --batch-size is per process, so the effective batch size is batch_size * world_size
+# NOTE: Checkpoints hold the config and state_dict. To load them:
+#   checkpoint = torch.load(path)
+#   model = TimeSeriesTransformer(**checkpoint["config"])
+#   model.load_state_dict(checkpoint["model"])
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Dataset, DataLoader, Subset
+from torch.utils.data.distributed import DistributedSampler
+import argparse
+import os
+import math
+import h5py
+import time
+import pickle
+import random
+import numpy as np
+
+disp_index, force_index, input_index = 0,1,2 # assign english names to the indexes for readability
+
+# MODEL =======================================================================================================================
+
+class PositionalEncoding(nn.Module):
+    batch_first = False # default for models saved before batch_first was added
+
+    def __init__(self, d_model, max_len=1000, batch_first=False):
+        super(PositionalEncoding, self).__init__()
+        self.batch_first = batch_first
+
+        # Compute the positional encodings once in log space.
+        pe = torch.zeros(max_len, d_model)
+        position = torch.arange(0, max_len).unsqueeze(1).float()
+        div_term = torch.exp(torch.arange(0, d_model, 2).float() * -(math.log(10000.0) / d_model))
+        pe[:, 0::2] = torch.sin(position * div_term)
+        pe[:, 1::2] = torch.cos(position * div_term)
+        pe = pe.unsqueeze(1)
+        self.register_buffer('pe', pe)
+
+    def forward(self, x):
+        if self.batch_first:
+            x = x + self.pe[:x.size(1), :, :].transpose(0, 1) # (L, 1, D) -> (1, L, D)
+        else:
+            x = x + self.pe[:x.size(0), :, :]
+        return x
+
+class TimeSeriesTransformer(nn.Module):
+    batch_first = False # default for models saved before batch_first was added
+
+    def __init__(self, d_model, nhead, num_encoder_layers, num_decoder_layers, dim_feedforward, metadata_features, batch_first=False):
+        super(TimeSeriesTransformer, self).__init__()
+        self.batch_first = batch_first # keep (B, L, D) throughout instead of permuting to (L, B, D)
+
+        # Metadata embedding
+        self.metadata_embedding = nn.Linear(3, metadata_features)
+
+        # Time series embedding and encoder
+        self.embedding = nn.Linear(1, (d_model-metadata_features))
+        self.pos_encoder = PositionalEncoding((d_model-metadata_features), batch_first=batch_first)
+        self.encoder_layer = nn.TransformerEncoderLayer(d_model=d_model, nhead=nhead, dim_feedforward=dim_feedforward, batch_first=batch_first)
+        self.transformer_encoder = nn.TransformerEncoder(self.encoder_layer, num_layers=num_encoder_layers, enable_nested_tensor=False) # no nested tensor fast path, eval treats padding like training
+
+        # Decoder for force
+        self.decoder_layer_force = nn.TransformerDecoderLayer(d_model=d_model, nhead=nhead, dim_feedforward=dim_feedforward, batch_first=batch_first)
+        self.transformer_decoder_force = nn.TransformerDecoder(self.decoder_layer_force, num_layers=num_decoder_layers)
+        self.output_force = nn.Linear(d_model, 1)
+
+        # Decoder for disp
+        self.decoder_layer_disp = nn.TransformerDecoderLayer(d_model=d_model, nhead=nhead, dim_feedforward=dim_feedforward, batch_first=batch_first)
+        self.transformer_decoder_disp = nn.TransformerDecoder(self.decoder_layer_disp, num_layers=num_decoder_layers)
+        self.output_disp = nn.Linear(d_model, 1)
+
+    def forward(self, seq1, padding_mask, metadata):
+        seq_len = seq1.shape[1]
+
+        # Prepare Metadata
+        metadata_embed = self.metadata_embedding(metadata) # embed the metadata [32,3] -> [32,30]
+        metadata_embed = metadata_embed.unsqueeze(1) # [32,30] -> [32,1,30]
+        expanded_metadata = metadata_embed.expand(-1, seq_len, -1) # [32,1,30] -> [32,240,30]
+        if not self.batch_first:
+            expanded_metadata = torch.permute(expanded_metadata, (1, 0, 2))
+
+        # Preparing Time Series Input
+        if not self.batch_first:
+            seq1 = torch.permute(seq1, (1, 0, 2))  # reshape (B, L, D) -> (L, B, D)
+        seq1_embedded = self.embedding(seq1) # embed the input sequence [32, 240, 1] -> [32, 240, 226]
+        seq1_pos_encoded = self.pos_encoder(seq1_embedded) # positional encoding on just time series
+
+        # Combine Metadata and Input
+        encoder_input = torch.cat((expanded_metadata, seq1_pos_encoded), dim=2) # combine into one input [32,240,256]
+
+        memory = self.transformer_encoder(encoder_input, src_key_padding_mask=padding_mask)
+
+        # Force and displacement decoders
+        output_force = self.transformer_decoder_force(memory, memory, tgt_key_padding_mask=padding_mask)
+        output_force = self.output_force(output_force)
+        if not self.batch_first:
+            output_force = output_force.permute(1,0,2) # change the shape back to (B, L, D)
+
+        output_disp = self.transformer_decoder_disp(memory, memory, tgt_key_padding_mask=padding_mask)
+        output_disp = self.output_disp(output_disp)
+        if not self.batch_first:
+            output_disp = output_disp.permute(1,0,2)
+
+        return output_force, output_disp
+
+# FUNCTIONS ===================================================================================================================
+
+# Custom dataset class
+class TimeSeriesDataset(Dataset):
+    def __init__(self, input_data, target_force, target_disp, mask_list, metadata, plotting_data):
+        self.input_data = torch.from_numpy(np.array(input_data)).float()
+        self.target_force = torch.from_numpy(np.array(target_force)).float()
+        self.target_disp = torch.from_numpy(np.array(target_disp)).float()
+        self.mask_list = torch.from_numpy(np.array(mask_list)).float()
+        self.metadata = torch.from_numpy(np.array(metadata)).float()
+        self.plotting_data = plotting_data
+
+    def __len__(self):
+        return len(self.input_data)
+
+    def __getitem__(self, idx):
+        return (
+            self.input_data[idx],       # 0
+            self.target_force[idx],     # 1
+            self.target_disp[idx],      # 2
+            self.mask_list[idx],        # 3
+            self.metadata[idx],         # 4
+            self.plotting_data[idx]     # 5
+        )
+
+# Set random seed for everything at once
+def seed_everything(seed = 13):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+# Normalize sequence to have mean = 0 and std = 1
+def normalize_columns(matrix):
+    col_means = matrix.mean(axis=0)
+    col_stds = matrix.std(axis=0)
+    if np.any(col_stds==0):
+        print("ERROR: Standard Deviation is 0. Check that all series vary in value")
+    normalized_series = (matrix - col_means) / col_stds
+    return normalized_series, [col_means, col_stds]
+
+def normalize_all_columns(ts_data):
+    normalized_ts_data, original_mean_std = [], [] # Initialize
+    for sequence in ts_data:
+        norm_seq, mean_std = normalize_columns(sequence[:, 0:5])  # normalize the first 5 columns
+        normalized_ts_data.append(norm_seq)
+        original_mean_std.append(mean_std)
+    return normalized_ts_data, original_mean_std
+
+def denormalize(normalized_sequence, original_mean, original_std):
+    denormalized_sequence = (normalized_sequence * original_std) + original_mean
+    return denormalized_sequence
+
+# Add padding to max length
+def pad_data(ts_data):
+    padded_series_list, ppl_list, mask_list = [], [], []
+    max_length = max(len(series) for series in ts_data)  # Find the length of the longest time series
+    for series in ts_data:
+        padding_length = max_length - len(series)  # Calculate the number of rows to pad
+        padding = np.zeros((padding_length, series.shape[1]))  # Create the padding rows
+        padded_series_list.append(np.vstack((series, padding)))  # Append the padding to the end of the series
+        ppl_list.append(len(series))  # Record the original series length to remove padding later
+        mask_list.append([False] * len(series) + [True] * padding_length)  # True where padding is added
+    return padded_series_list, ppl_list, mask_list
+
+# Define Loss Function
+def loss_function(pred_force, target_batch_force, pred_disp, target_batch_disp):
+    mse_loss_force = nn.MSELoss()(pred_force, target_batch_force)
+    mse_loss_disp = nn.MSELoss()(pred_disp, target_batch_disp)
+    l1_loss_force = nn.L1Loss()(pred_force, target_batch_force)
+    l1_loss_disp = nn.L1Loss()(pred_disp, target_batch_disp)
+    return (mse_loss_force + mse_loss_disp) + 0.15 * (l1_loss_force + l1_loss_disp)
+
+# Combined RMSE function
+def combined_rmse(target_force, pred_force, target_disp, pred_disp):
+    Y_combined = np.concatenate((target_force, target_disp))
+    Ypre_combined = np.concatenate((pred_force, pred_disp))
+    return np.sqrt(np.mean((Y_combined - Ypre_combined) ** 2))
+
+# Combined R Squared function
+def combined_r2(target_force, pred_force, target_disp, pred_disp):
+    Y_combined = np.concatenate((target_force, target_disp))
+    Ypre_combined = np.concatenate((pred_force, pred_disp))
+    ssr = np.sum((Y_combined - Ypre_combined) ** 2)
+    sst = np.sum((Y_combined - np.mean(Y_combined)) ** 2)
+    return 1 - (ssr / sst)
+
+# Load the HDF5, normalize and pad, and split by stackup into dataset1 (train) and dataset2_test (held-out)
+def load_datasets(data_path, stackup_set_1=(2, 3), stackup_set_2=(1,), test_split=0.2):
+    ts_data, weld_names, stackup_IDs, set_currents, set_forces = [], [], [], [], []
+    with h5py.File(data_path, 'r') as file:
+        for weld_name in file:
+            ts_data.append(file[weld_name][:]) # add whole time series matrix to the ts_data array
+            weld_names.append(weld_name)
+            stackup_IDs.append(file[weld_name].attrs['CustomStackup'])
+            set_currents.append(file[weld_name].attrs['Current_S1 (kA)'])
+            set_forces.append(file[weld_name].attrs['Force_S1'])
+
+    # Normalize and Pad Data
+    normalized_ts_data, original_mean_std = normalize_all_columns(ts_data)
+    padded_series_list, ppl_list, mask_list = pad_data(normalized_ts_data)
+
+    # Prepare attributes and plotting data
+    metadata, plotting_data = [], []
+    for i in range(len(ts_data)):
+        metadata.append([stackup_IDs[i], set_currents[i], set_forces[i]])
+        plotting_data.append([weld_names[i], ppl_list[i],
+                              original_mean_std[i][0][input_index], original_mean_std[i][1][input_index],
+                              original_mean_std[i][0][force_index], original_mean_std[i][1][force_index],
+                              original_mean_std[i][0][disp_index], original_mean_std[i][1][disp_index]])
+
+    # Extract resistance (input), force and displacement (targets)
+    padded_ts_data = np.array(padded_series_list)
+    ts_dataset = TimeSeriesDataset(padded_ts_data[:,:,input_index][:, :, None],
+                                   padded_ts_data[:,:,force_index][:, :, None],
+                                   padded_ts_data[:,:,disp_index][:, :, None],
+                                   mask_list, np.array(metadata), plotting_data)
+
+    # Collect indices for each set based on stackup ID
+    dataset1_indices = [i for i in range(len(ts_data)) if stackup_IDs[i] in stackup_set_1]
+    dataset2_indices = [i for i in range(len(ts_data)) if stackup_IDs[i] in stackup_set_2]
+    split_index = int(len(dataset2_indices) * test_split) # set percent of data used for testing
+    dataset1 = Subset(ts_dataset, dataset1_indices)
+    dataset2_train = Subset(ts_dataset, dataset2_indices[split_index:])
+    dataset2_test = Subset(ts_dataset, dataset2_indices[:split_index])
+    return dataset1, dataset2_train, dataset2_test
+
+# Test a model one weld at a time and return the average loss, RMSE, R^2 and the denormalized results for plotting
+# The fast path is turned off so the float padding mask is added to the attention scores exactly as in training
+# (batch_first models would otherwise take the fused encoder layer path in eval, which converts it to a bool mask)
+def evaluate_model(model, dataset):
+    model.eval() # switch to evaluation mode
+    loss_array, rmse_array, r2_array, results = [], [], [], []
+    fastpath_enabled = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(False)
+    with torch.no_grad():
+        for sample in dataset:
+            # unpack data (add extra dimension [260, 1] --> [1, 260, 1])
+            input_test = sample[0].unsqueeze(0)
+            target_test_force = sample[1].unsqueeze(0)
+            target_test_disp = sample[2].unsqueeze(0)
+            mask_test = sample[3].unsqueeze(0)
+            metadata_test = sample[4].unsqueeze(0)
+            plotting_test = sample[5]
+
+            # Forward pass and metrics
+            pred_force, pred_disp = model(input_test, mask_test, metadata_test)
+            loss_array.append(loss_function(pred_force, target_test_force, pred_disp, target_test_disp).item())
+            rmse_array.append(combined_rmse(target_test_force, pred_force, target_test_disp, pred_disp))
+            r2_array.append(combined_r2(target_test_force, pred_force, target_test_disp, pred_disp))
+
+            # Prepare Results
+            '''plotting_data: [weld_names[i], ppl_list[i], input_mean, input_std, force_mean, force_std, disp_mean, disp_std]'''
+            weld_id = plotting_test[0]
+            orig_len = plotting_test[1] # original length
+            dr_curve = denormalize(input_test.squeeze()[:orig_len], *plotting_test[2:4]).numpy()
+            target_force = denormalize(target_test_force.squeeze()[:orig_len], *plotting_test[4:6]).numpy()
+            pred_force1 = denormalize(pred_force.squeeze()[:orig_len], *plotting_test[4:6]).numpy()
+            target_disp = denormalize(target_test_disp.squeeze()[:orig_len], *plotting_test[6:8]).numpy()
+            pred_disp1 = denormalize(pred_disp.squeeze()[:orig_len], *plotting_test[6:8]).numpy()
+            results.append([weld_id,target_force,pred_force1,target_disp,pred_disp1,dr_curve])
+    torch.backends.mha.set_fastpath_enabled(fastpath_enabled)
+    return sum(loss_array) / len(loss_array), sum(rmse_array) / len(rmse_array), sum(r2_array) / len(r2_array), results
+
+# DISTRIBUTED TRAINING ========================================================================================================
+
+# Split the available cores between the processes running on this machine
+def configure_rank_threads(local_world_size):
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    torch.set_num_threads(max(1, cores // local_world_size))
+
+# Training loop run by every rank
+def train_worker(rank, world_size, args):
+    # Rendezvous (torchrun sets these itself, spawned processes use localhost)
+    os.environ.setdefault("MASTER_ADDR", "localhost")
+    os.environ.setdefault("MASTER_PORT", str(args.port))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    configure_rank_threads(int(os.environ.get("LOCAL_WORLD_SIZE", world_size)))
+
+    # Every rank builds the same preprocessed dataset and samples its own shard of dataset1
+    seed_everything(42)
+    dataset1, _, dataset2_test = load_datasets(args.data)
+    sampler = DistributedSampler(dataset1, num_replicas=world_size, rank=rank, shuffle=True, seed=42)
+    dataset1_batched = DataLoader(dataset1, batch_size=args.batch_size, sampler=sampler)
+
+    # Define Model (same seed on every rank, DDP also broadcasts rank 0's weights)
+    config = {"d_model": args.d_model, "nhead": args.nhead, "num_encoder_layers": args.num_encoder_layers, "num_decoder_layers": args.num_decoder_layers,
+              "dim_feedforward": args.dim_feedforward, "metadata_features": args.metadata_features, "batch_first": True}
+    model = TimeSeriesTransformer(**config)
+
+    # The encoder/decoder deep-copy these template layers, so they never get gradients and DDP would wait on them forever
+    for template_layer in (model.encoder_layer, model.decoder_layer_force, model.decoder_layer_disp):
+        template_layer.requires_grad_(False)
+    ddp_model = DistributedDataParallel(model) # all-reduces gradients during backward
+    optimizer = torch.optim.Adam(ddp_model.parameters(), lr=args.learning_rate)
+
+    if rank == 0:
+        os.makedirs(args.model_save_folder, exist_ok=True)
+        print(f"World Size: {world_size} \tThreads per Rank: {torch.get_num_threads()} \tBatches per Rank: {len(dataset1_batched)}")
+    model_save_path = os.path.join(args.model_save_folder, args.model_save_name)
+
+    # Training loop
+    train_losses, epoch_times = [], []
+    ddp_model.train() # put model in training mode
+    for epoch in range(args.epochs):
+        sampler.set_epoch(epoch) # reshuffle the shards every epoch
+        epoch_start = time.perf_counter()
+        train_loss = torch.zeros(2) # [loss sum, batch count]
+
+        for batch in dataset1_batched:
+            # Forward pass (bf16 autocast runs the linear/attention layers in bfloat16)
+            with torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=args.bf16):
+                pred_force, pred_disp = ddp_model(batch[0], batch[3], batch[4])
+            loss = loss_function(pred_force.float(), batch[1], pred_disp.float(), batch[2])
+
+            # Backward pass and optimization
+            optimizer.zero_grad() # clear old gradients
+            loss.backward() # backpropogation and gradient all-reduce
+            optimizer.step()
+
+            train_loss += torch.tensor([loss.item(), 1.0])
+
+        # Average the loss over every rank
+        dist.all_reduce(train_loss)
+        avg_train_loss = (train_loss[0] / train_loss[1]).item()
+        epoch_times.append(time.perf_counter() - epoch_start)
+        train_losses.append(avg_train_loss)
+
+        # Print, checkpoint and save the losses from rank 0 only
+        if rank == 0 and ((epoch+1) % 50 == 0 or epoch == 0 or epoch+1 == args.epochs):
+            print(f"Epoch {epoch+1}/{args.epochs}, Training Loss: {avg_train_loss:.4f}, Epoch Time: {epoch_times[-1]:.2f}s")
+            torch.save({"config": config, "model": ddp_model.module.state_dict()}, f"{model_save_path}.pth") # spawned ranks run as __mp_main__, so pickling the module would not load elsewhere
+            with open(f"{model_save_path}_loss.pkl", 'wb') as file:
+                pickle.dump(train_losses, file)
+            with open(f"{model_save_path}_epoch_times.pkl", 'wb') as file:
+                pickle.dump(epoch_times, file)
+
+    # Test on the held-out stackup
+    if rank == 0:
+        average_loss, average_rmse, average_r2, _ = evaluate_model(ddp_model.module, dataset2_test)
+        print(f"Average RMSE: {average_rmse:.5f}")
+        print(f"Average R^2: {average_r2:.5f}")
+        print(f"Average Loss: {average_loss:.5f}")
+        open(os.path.join(args.model_save_folder, f"LOSS_STANDARD_{average_loss:.5f}__RMSE_{average_rmse:.5f}__R2_{average_r2:.5f}__RANKS_{world_size}.txt"), 'w')
+
+    dist.destroy_process_group()
+
+# Train once for each world size and report epoch time, speedup and efficiency
+def scaling_report(args):
+    report, base_time = [], None
+    base_name = args.model_save_name
+    for world_size in args.scaling_report:
+        args.model_save_name = f"{base_name}_ranks_{world_size}"
+        mp.spawn(train_worker, args=(world_size, args), nprocs=world_size, join=True)
+        with open(os.path.join(args.model_save_folder, f"{args.model_save_name}_epoch_times.pkl"), 'rb') as file:
+            epoch_times = pickle.load(file)
+        epoch_time = np.mean(epoch_times[1:]) if len(epoch_times) > 1 else epoch_times[0] # skip the warm-up epoch
+        if base_time is None: # speedup and efficiency are relative to the first world size
+            base_time, base_ranks = epoch_time, world_size
+        speedup = base_time / epoch_time
+        report.append(f"{world_size}\t{epoch_time:.3f}\t{speedup:.2f}x\t{speedup * base_ranks / world_size:.0%}")
+    args.model_save_name = base_name
+
+    report = "\n".join(["Ranks\tEpoch Time (s)\tSpeedup\tEfficiency"] + report)
+    print(report)
+    with open(os.path.join(args.model_save_folder, f"{base_name}_scaling_report.txt"), 'w') as file:
+        file.write(report + "\n")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Distributed CPU training for the signal generation transformer")
+    parser.add_argument("--data", required=True, help="path to the HDF5 database")
+    parser.add_argument("--model-save-folder", default="Model 10 DDP")
+    parser.add_argument("--model-save-name", default="model_10_ddp")
+    parser.add_argument("--nproc", type=int, default=1, help="processes to spawn when not launched with torchrun")
+    parser.add_argument("--port", type=int, default=29500, help="rendezvous port for spawned processes")
+    parser.add_argument("--scaling-report", type=int, nargs="+", help="world sizes to train and compare, e.g. 1 2 4 8")
+    parser.add_argument("--bf16", action="store_true", help="use bf16 autocast on the forward pass")
+    parser.add_argument("--epochs", type=int, default=600)
+    parser.add_argument("--batch-size", type=int, default=32, help="batch size per process")
+    parser.add_argument("--learning-rate", type=float, default=0.0001)
+    parser.add_argument("--d-model", type=int, default=256)
+    parser.add_argument("--nhead", type=int, default=4)
+    parser.add_argument("--num-encoder-layers", type=int, default=4)
+    parser.add_argument("--num-decoder-layers", type=int, default=4)
+    parser.add_argument("--dim-feedforward", type=int, default=1024)
+    parser.add_argument("--metadata-features", type=int, default=30) # 30 is optimal
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.scaling_report:
+        scaling_report(args)
+    elif "RANK" in os.environ: # launched by torchrun
+        train_worker(int(os.environ["RANK"]), int(os.environ["WORLD_SIZE"]), args)
+    else:
+        mp.spawn(train_worker, args=(args.nproc, args), nprocs=args.nproc, join=True)
@@ -0,0 +1,193 @@
+# signal_generation_transformer_search.py
+# University of Kentucky
+
+# HYPERPARAMETER SEARCH
+# Runs many Transformer Signal Generation 10 configurations concurrently on the CPU with successive halving.
+# Every trial trains for a small number of epochs, the best 1/eta by validation loss are promoted and
+# trained eta times longer, and the rest stop early. The HDF5 is loaded, normalized and padded once and the
+# padded tensors are placed in shared memory so every worker process trains from the same copy.
+# Validation welds are split off the training stackups; RMSE/R^2 are reported on the held-out stackup.
+#
+# USAGE:
+#   python signal_generation_transformer_search.py --data "DOE 1 v3 [Modified].h5" --workers 8 --metadata-features 10 20 30 --num-layers 2 4
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
+import argparse
+import itertools
+import random
+import time
+import os
+
+from signal_generation_transformer_ddp import TimeSeriesTransformer, seed_everything, load_datasets, loss_function, evaluate_model
+
+# Datasets shared with the worker processes (set by init_worker)
+shared_datasets = {}
+
+# FUNCTIONS ===================================================================================================================
+
+# Build every valid configuration from the parameter lists
+def build_configs(args):
+    configs = []
+    for d_model, nhead, num_layers, dim_feedforward, metadata_features, learning_rate in itertools.product(
+            args.d_model, args.nhead, args.num_layers, args.dim_feedforward, args.metadata_features, args.learning_rate):
+        if d_model % nhead != 0 or (d_model - metadata_features) % 2 != 0 or metadata_features >= d_model:
+            continue # attention heads must divide d_model and the positional encoding needs an even width
+        configs.append({"d_model": d_model, "nhead": nhead, "num_encoder_layers": num_layers, "num_decoder_layers": num_layers,
+                        "dim_feedforward": dim_feedforward, "metadata_features": metadata_features, "learning_rate": learning_rate})
+    if args.num_trials and args.num_trials < len(configs):
+        configs = random.Random(42).sample(configs, args.num_trials)
+    return configs
+
+# Epoch budget of each rung: min_epochs, min_epochs * eta, ... up to max_epochs
+def rung_epochs(min_epochs, max_epochs, eta):
+    rungs = [min_epochs]
+    while rungs[-1] < max_epochs:
+        rungs.append(min(rungs[-1] * eta, max_epochs))
+    return rungs
+
+# Shared memory tensors are passed to each worker by handle instead of being copied
+def share_datasets(datasets):
+    base_dataset = datasets["train"].dataset
+    for tensor in (base_dataset.input_data, base_dataset.target_force, base_dataset.target_disp, base_dataset.mask_list, base_dataset.metadata):
+        tensor.share_memory_()
+    return datasets
+
+def init_worker(datasets, num_threads):
+    shared_datasets.update(datasets)
+    torch.set_num_threads(num_threads)
+
+# Train one trial up to the rung's epoch budget, resuming from its checkpoint
+def run_trial(trial_id, config, epochs, checkpoint_folder, use_bf16):
+    checkpoint_path = os.path.join(checkpoint_folder, f"trial_{trial_id}.pth")
+    seed_everything(trial_id)
+    model = TimeSeriesTransformer(config["d_model"], config["nhead"], config["num_encoder_layers"], config["num_decoder_layers"],
+                                  config["dim_feedforward"], config["metadata_features"], batch_first=True)
+    optimizer = torch.optim.Adam(model.parameters(), lr=config["learning_rate"])
+    start_epoch, train_losses = 0, []
+    checkpoint = torch.load(checkpoint_path) if os.path.exists(checkpoint_path) else None
+    if checkpoint is not None and checkpoint["epoch"] <= epochs: # checkpoint from the previous rung of this search
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        start_epoch, train_losses = checkpoint["epoch"], checkpoint["train_losses"]
+        torch.set_rng_state(checkpoint["rng_state"]) # continue the shuffle/dropout stream instead of replaying it
+
+    # Training loop
+    train_batched = DataLoader(shared_datasets["train"], batch_size=32, shuffle=True)
+    model.train() # put model in training mode
+    for epoch in range(start_epoch, epochs):
+        train_loss = 0.0
+        for batch in train_batched:
+            with torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=use_bf16):
+                pred_force, pred_disp = model(batch[0], batch[3], batch[4])
+            loss = loss_function(pred_force.float(), batch[1], pred_disp.float(), batch[2])
+            optimizer.zero_grad() # clear old gradients
+            loss.backward() # backpropogation
+            optimizer.step()
+            train_loss += loss.item()
+        train_losses.append(train_loss / len(train_batched))
+
+    torch.save({"config": config, "model": model.state_dict(), "optimizer": optimizer.state_dict(), "epoch": epochs, "train_losses": train_losses,
+                "rng_state": torch.get_rng_state()}, checkpoint_path)
+
+    # Validation loss decides promotion
+    val_loss, _, _, _ = evaluate_model(model, shared_datasets["val"])
+    return {"trial_id": trial_id, "config": config, "epochs": epochs, "train_loss": train_losses[-1], "val_loss": val_loss}
+
+# Test a trial's last checkpoint on the held-out stackup (only once it is eliminated or finishes the final rung)
+def test_trial(trial_id, checkpoint_folder):
+    checkpoint = torch.load(os.path.join(checkpoint_folder, f"trial_{trial_id}.pth"))
+    config = checkpoint["config"]
+    model = TimeSeriesTransformer(config["d_model"], config["nhead"], config["num_encoder_layers"], config["num_decoder_layers"],
+                                  config["dim_feedforward"], config["metadata_features"], batch_first=True)
+    model.load_state_dict(checkpoint["model"])
+    test_loss, test_rmse, test_r2, _ = evaluate_model(model, shared_datasets["test"])
+    return {"test_loss": test_loss, "test_rmse": test_rmse, "test_r2": test_r2}
+
+# Successive halving over all configurations, with checkpoints in this run's own folder
+def successive_halving(configs, datasets, args, run_folder):
+    num_threads = max(1, (len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()) // args.workers)
+    results = {}
+    trial_ids = list(range(len(configs)))
+    with mp.get_context("spawn").Pool(args.workers, initializer=init_worker, initargs=(datasets, num_threads)) as pool:
+        for rung, epochs in enumerate(rung_epochs(args.min_epochs, args.max_epochs, args.eta)):
+            print(f"Rung {rung+1}: {len(trial_ids)} trials for {epochs} epochs")
+            rung_results = pool.starmap(run_trial, [(trial_id, configs[trial_id], epochs, run_folder, args.bf16) for trial_id in trial_ids])
+            for result in rung_results:
+                result["rung"] = rung + 1
+                results[result["trial_id"]] = result
+                print(f"\tTrial {result['trial_id']}: Validation Loss: {result['val_loss']:.5f} \t{result['config']}")
+
+            # Promote the best 1/eta by validation loss (nobody is promoted past the final rung)
+            rung_results.sort(key=lambda result: result["val_loss"])
+            num_promoted = max(1, len(rung_results) // args.eta) if epochs < args.max_epochs else 0
+            trial_ids = [result["trial_id"] for result in rung_results[:num_promoted]]
+
+            # Test the trials that stop here on the held-out stackup
+            stopped_ids = [result["trial_id"] for result in rung_results[num_promoted:]]
+            for trial_id, test_result in zip(stopped_ids, pool.starmap(test_trial, [(trial_id, run_folder) for trial_id in stopped_ids])):
+                results[trial_id].update(test_result)
+    return list(results.values())
+
+# Rank trials by how far they got, then by RMSE on the held-out stackup
+def write_leaderboard(results, save_path):
+    results = sorted(results, key=lambda result: (-result["rung"], result["test_rmse"]))
+    lines = ["Rank\tTrial\tEpochs\tVal Loss\tRMSE\tR^2\tConfig"]
+    for rank, result in enumerate(results):
+        lines.append(f"{rank+1}\t{result['trial_id']}\t{result['epochs']}\t{result['val_loss']:.5f}\t{result['test_rmse']:.5f}\t{result['test_r2']:.5f}\t{result['config']}")
+    leaderboard = "\n".join(lines)
+    print(leaderboard)
+    with open(save_path, 'w') as file:
+        file.write(leaderboard + "\n")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Successive halving hyperparameter search for the signal generation transformer")
+    parser.add_argument("--data", required=True, help="path to the HDF5 database")
+    parser.add_argument("--model-save-folder", default="Model 10 Search")
+    parser.add_argument("--workers", type=int, default=4, help="trials trained at the same time")
+    parser.add_argument("--num-trials", type=int, help="randomly sample this many configurations from the grid")
+    parser.add_argument("--min-epochs", type=int, default=25, help="epochs every trial trains before the first cut")
+    parser.add_argument("--max-epochs", type=int, default=600)
+    parser.add_argument("--eta", type=int, default=3, help="keep the best 1/eta trials at each rung")
+    parser.add_argument("--val-split", type=float, default=0.1, help="fraction of the training stackups used for validation")
+    parser.add_argument("--bf16", action="store_true", help="use bf16 autocast on the forward pass")
+    parser.add_argument("--d-model", type=int, nargs="+", default=[256])
+    parser.add_argument("--nhead", type=int, nargs="+", default=[4])
+    parser.add_argument("--num-layers", type=int, nargs="+", default=[4], help="encoder and decoder layers")
+    parser.add_argument("--dim-feedforward", type=int, nargs="+", default=[1024])
+    parser.add_argument("--metadata-features", type=int, nargs="+", default=[30])
+    parser.add_argument("--learning-rate", type=float, nargs="+", default=[0.0001])
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.num_trials is not None and args.num_trials < 1:
+        parser.error("--num-trials must be at least 1")
+    if args.eta < 2:
+        parser.error("--eta must be at least 2")
+    if not 0 < args.val_split < 1:
+        parser.error("--val-split must be between 0 and 1")
+    if args.min_epochs < 1 or args.min_epochs > args.max_epochs:
+        parser.error("--min-epochs must be between 1 and --max-epochs")
+    if not build_configs(args):
+        parser.error("no valid configuration: nhead must divide d_model and d_model - metadata_features must be even and positive")
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    # Preprocess once and split validation welds off the training stackups
+    seed_everything(42)
+    dataset1, _, dataset2_test = load_datasets(args.data)
+    shuffled_indices = list(dataset1.indices)
+    random.Random(42).shuffle(shuffled_indices)
+    val_size = max(1, int(len(shuffled_indices) * args.val_split))
+    train_indices, val_indices = shuffled_indices[val_size:], shuffled_indices[:val_size]
+    datasets = share_datasets({"train": Subset(dataset1.dataset, train_indices), "val": Subset(dataset1.dataset, val_indices), "test": dataset2_test})
+
+    configs = build_configs(args)
+    print(f"Trials: {len(configs)} \tWorkers: {args.workers} \tTrain: {len(train_indices)} \tValidation: {len(val_indices)} \tTest: {len(dataset2_test)}")
+    run_folder = os.path.join(args.model_save_folder, f"search_{time.strftime('%Y%m%d_%H%M%S')}") # new folder per run so old checkpoints are never resumed
+    os.makedirs(run_folder, exist_ok=True)
+    results = successive_halving(configs, datasets, args, run_folder)
+    write_leaderboard(results, os.path.join(run_folder, "leaderboard.txt"))